@@ -4,17 +4,18 @@ import time
 import os
 from O365 import Account, FileSystemTokenBackend
 import imaplib
-import requests
-import shutil
-import html
+import asyncio
+import aiohttp
 import re
+from html.parser import HTMLParser
 import csv
 import base64
+import itertools
+from concurrent.futures import ThreadPoolExecutor
 
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.base import MIMEBase
-from email import encoders
 
 
 # Load OAuth2 constants from config.json
@@ -37,6 +38,37 @@ SOURCE_CLIENT_ID = config.get('SOURCE_CLIENT_ID')
 SOURCE_CLIENT_SECRET = config.get('SOURCE_CLIENT_SECRET')
 SOURCE_TENANT_ID = config.get('SOURCE_TENANT_ID')
 MIGRATE_ATTACHMENTS = config.get('MIGRATE_ATTACHMENTS', False)
+MAX_CONCURRENT_REQUESTS = config.get('MAX_CONCURRENT_REQUESTS', 8)
+MAX_PARALLEL_MAILBOXES = config.get('MAX_PARALLEL_MAILBOXES', 32)
+IMAP_CONNECTIONS_PER_MAILBOX = config.get('IMAP_CONNECTIONS_PER_MAILBOX', 4)
+MULTIAPPEND_BATCH_SIZE = config.get('MULTIAPPEND_BATCH_SIZE', 50)
+MULTIAPPEND_BATCH_BYTES = config.get('MULTIAPPEND_BATCH_BYTES', 10 * 1024 * 1024)
+
+# Microsoft Graph JSON batching endpoint and its per-request limit
+GRAPH_BATCH_URL = 'https://graph.microsoft.com/v1.0/$batch'
+GRAPH_BATCH_SIZE = 20
+
+# Seconds an idle Graph connection is kept open for reuse
+GRAPH_KEEPALIVE_TIMEOUT = 60
+
+# Graph responses worth retrying (throttling and transient server errors) and how often to retry them
+GRAPH_RETRY_STATUSES = (429, 500, 502, 503, 504)
+GRAPH_MAX_RETRIES = 5
+
+# Message fields listed per folder, fields needed to rebuild an email, and the page sizes used when listing messages and folders
+MESSAGE_LIST_FIELDS = 'id,hasAttachments'
+MESSAGE_FIELDS = 'id,subject,from,toRecipients,ccRecipients,bccRecipients,receivedDateTime,body,hasAttachments'
+MESSAGE_PAGE_SIZE = 1000
+FOLDER_PAGE_SIZE = 100
+
+# Folders fetched at the same time per mailbox, and fetched messages allowed to wait for migration
+MAX_CONCURRENT_FOLDERS = 4
+MAX_QUEUED_MESSAGES = 100
+
+# Precompiled patterns used when cleaning message bodies and folder names
+_WS_RE = re.compile(r'\s+')
+_ILLEGAL_RE = re.compile(r'[<>:"/\\|?*]')
+_QUOTE_RE = re.compile(r'[\s"\\(){%*\]]')  # Characters that force an IMAP mailbox name to be quoted
 
 # Global variable to store the authorization code
 auth_code = None
@@ -44,6 +76,22 @@ auth_code = None
 # Create a lock for thread-safe printing
 print_lock = threading.Lock()
 
+# Messages migrated per (source, target) mailbox pair; each entry is only written by its own mailbox's event loop,
+# and a background thread reads them to print progress
+_PROGRESS = {}
+PROGRESS_INTERVAL = 0.1
+
+# In-memory caches shared by all mailbox threads:
+# (tenant, client) -> (access_token, expires_at, account) and email -> Graph folder listing
+_TOKEN_CACHE = {}
+_FOLDER_CACHE = {}
+token_lock = threading.Lock()
+cache_lock = threading.Lock()
+
+# Re-authenticate when the access token expires within this many seconds; mailboxes that outlive
+# their token refresh it on a 401 response
+TOKEN_EXPIRY_MARGIN = 600
+
 def safe_print(message, end="\n"):
     """Thread-safe print function that flushes the output immediately."""
     with print_lock:
@@ -57,146 +105,433 @@ def update_progress(message, final=False):
         # Print with carriage return to overwrite the line
         safe_print(message, end="\r")
 
-def authenticate_account(target_email):
-    tokens_dir = 'tokens'
-    account_tokens_dir = os.path.join(tokens_dir, f'token_{target_email}')
-    token_path = os.path.join(account_tokens_dir, 'o365_token.txt')
-
-    # Ensure the directory exists
-    if os.path.exists(token_path):
-        shutil.rmtree(account_tokens_dir)
-
-    if not os.path.exists(account_tokens_dir):
-        os.makedirs(account_tokens_dir)
+def report_progress(stop_event):
+    """Writes one aggregated progress line at most every PROGRESS_INTERVAL seconds until stopped."""
+    last_line = None
+    while not stop_event.wait(PROGRESS_INTERVAL):
+        counts = list(_PROGRESS.values())
+        if not counts:
+            continue
+        line = f"Migrating Emails: {sum(counts)} migrated across {len(counts)} mailboxes"
+        if line != last_line:
+            update_progress(line)
+            last_line = line
+
+
+def read_access_token(token_path):
+    """Reads the access token stored by the O365 token backend, or returns None if there is none."""
+    if not os.path.exists(token_path):
+        return None
+    with open(token_path, 'r') as token_file:
+        return json.load(token_file).get('access_token')
 
-    # Re-authenticate if the token doesn't exist or is invalid
-    account = Account(
-        (SOURCE_CLIENT_ID, SOURCE_CLIENT_SECRET),
-        tenant_id=SOURCE_TENANT_ID,
-        token_backend=FileSystemTokenBackend(token_path=account_tokens_dir),
-        auth_flow_type='credentials'
-    )
 
-    if not account.is_authenticated:
-        print(f"Starting authentication for {target_email}.")
+def token_expiry(access_token):
+    """Returns the expiry time (epoch seconds) encoded in a JWT access token, or 0 if it cannot be read."""
+    try:
+        payload = access_token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)  # Restore the padding stripped by JWT encoding
+        return float(json.loads(base64.urlsafe_b64decode(payload))['exp'])
+    except (AttributeError, IndexError, KeyError, TypeError, ValueError):
+        return 0
+
+
+def token_directory():
+    """Returns the token store for the configured app, so a token is never reused for another tenant or client."""
+    return os.path.join('tokens', f'{SOURCE_TENANT_ID}_{SOURCE_CLIENT_ID}')
+
+
+def invalidate_token(access_token):
+    """Forgets a token Graph rejected, in memory and on disk, so the next authenticate_account fetches a new one."""
+    with token_lock:
+        key = (SOURCE_TENANT_ID, SOURCE_CLIENT_ID)
+        cached = _TOKEN_CACHE.get(key)
+        if cached and cached[0] == access_token:
+            del _TOKEN_CACHE[key]
+
+        # Only remove the stored token if another mailbox has not already replaced it
+        token_path = os.path.join(token_directory(), 'o365_token.txt')
+        if read_access_token(token_path) == access_token:
+            os.remove(token_path)
+
+
+def authenticate_account(source_email=None):
+    """Returns the app-only access token for the source tenant, acquiring it once for all mailboxes."""
+    # A client-credentials token grants access to every mailbox in the tenant, so it is shared.
+    # Holding the lock while authenticating makes other mailboxes wait for this token instead of fetching their own.
+    with token_lock:
+        cached = _TOKEN_CACHE.get((SOURCE_TENANT_ID, SOURCE_CLIENT_ID))
+        if cached and cached[1] - time.time() > TOKEN_EXPIRY_MARGIN:
+            return cached[0], cached[2]  # Token is still valid, skip the round-trip to Azure AD
+
+        tokens_dir = token_directory()
+        token_path = os.path.join(tokens_dir, 'o365_token.txt')
+
+        # Ensure the directory exists
+        if not os.path.exists(tokens_dir):
+            os.makedirs(tokens_dir)
+
+        account = Account(
+            (SOURCE_CLIENT_ID, SOURCE_CLIENT_SECRET),
+            tenant_id=SOURCE_TENANT_ID,
+            token_backend=FileSystemTokenBackend(token_path=tokens_dir),
+            auth_flow_type='credentials'
+        )
+
+        authenticated = False
         try:
-            account.authenticate(scopes=['https://graph.microsoft.com/.default'])
-            update_progress(f"Successfully authenticated for {target_email}.")
+            # Reuse the stored token while it is valid, otherwise re-authenticate
+            access_token = read_access_token(token_path)
+            if not access_token or token_expiry(access_token) - time.time() <= TOKEN_EXPIRY_MARGIN:
+                print(f"Starting authentication for tenant {SOURCE_TENANT_ID}.")
+                if not account.authenticate(scopes=['https://graph.microsoft.com/.default']):
+                    print(f"Authentication failed for tenant {SOURCE_TENANT_ID}.")
+                    return None, None
 
-            # Now read the access token directly from the token file after authentication
-            with open(token_path, 'r') as token_file:
-                token_data = json.load(token_file)
-                access_token = token_data.get('access_token')
+                authenticated = True
 
-            if access_token:
-                return access_token, account  # Return both the access token and account object
-            else:
-                print("Failed to retrieve access token after authentication.")
-                return None, None
+                # Now read the access token directly from the token file after authentication
+                access_token = read_access_token(token_path)
 
         except Exception as e:
-            print(f"An error occurred during authentication for {target_email}: {e}")
+            print(f"An error occurred during authentication for {source_email or SOURCE_TENANT_ID}: {e}")
             return None, None
 
-    return None, account  # If already authenticated, return the account object without the access token
+        # Never hand out the stale token a failed authentication may have left on disk
+        if not access_token or token_expiry(access_token) <= time.time():
+            print("Failed to retrieve a valid access token after authentication.")
+            return None, None
+
+        if authenticated:
+            update_progress(f"Successfully authenticated for tenant {SOURCE_TENANT_ID}.")
+        _TOKEN_CACHE[(SOURCE_TENANT_ID, SOURCE_CLIENT_ID)] = (access_token, token_expiry(access_token), account)
 
+    return access_token, account  # Return both the access token and account object
 
-def fetch_attachments(email_address, message_id, access_token):
-    """Fetch attachments for a given message."""
+
+def retry_delay(attempt, retry_after=None):
+    """Seconds to wait before retrying, honoring a Retry-After value and otherwise backing off exponentially."""
     try:
-        url = f"https://graph.microsoft.com/v1.0/users/{email_address}/messages/{message_id}/attachments"
-        headers = {
-            'Authorization': f'Bearer {access_token}',
-            'Content-Type': 'application/json'
-        }
-
-        response = requests.get(url, headers=headers)
-        if response.status_code == 200:
-            attachments = response.json().get('value', [])
-            return attachments
-        else:
-            print(f"Failed to fetch attachments for message {message_id}: {response.status_code} - {response.text}")
-            return []
-    except Exception as e:
-        print(f"Error fetching attachments for message {message_id}: {e}")
-        return []
+        return float(retry_after)
+    except (TypeError, ValueError):
+        return 2 ** attempt
 
 
-def fetch_all_emails(account, source_email, access_token):
-    """Fetch all emails from the source email account."""
-    if not account.is_authenticated:
-        print("Account is not authenticated. Cannot fetch emails.")
-        return []
+async def refresh_authorization(session):
+    """Replaces the session's rejected access token with a new one; returns True if the token changed."""
+    rejected_token = session.headers.get('Authorization', '').removeprefix('Bearer ')
+    await asyncio.to_thread(invalidate_token, rejected_token)
 
-    mailbox = account.mailbox()
-    folders = get_mail_folders(access_token, source_email)
-    if folders is None:
-        print("Failed to retrieve folders.")
-        return []
+    access_token, _ = await asyncio.to_thread(authenticate_account)
+    if access_token is None:
+        return False
+
+    authorization = f'Bearer {access_token}'
+    if session.headers.get('Authorization') == authorization:
+        return False  # The token is still considered valid, so retrying would not help
+    session.headers['Authorization'] = authorization
+    return True
 
-    all_emails = []
 
-    for folder in folders.get('value', []):
+async def graph_request(session, semaphore, method, url, raw=False, **kwargs):
+    """Sends a Graph request, retrying throttled (429) and transient (5xx) failures and refreshing an expired token (401).
+
+    Returns (status, data) where data is the decoded JSON (or the raw bytes if `raw`) on success
+    or the response text otherwise.
+    """
+    refreshed = False
+    for attempt in range(GRAPH_MAX_RETRIES + 1):
+        retry_after = None
         try:
-            folder_id = folder['id']
-            url = f"https://graph.microsoft.com/v1.0/users/{source_email}/mailFolders/{folder_id}/messages"
-            headers = {
-                'Authorization': f'Bearer {access_token}',
-                'Content-Type': 'application/json'
+            async with semaphore:
+                async with session.request(method, url, **kwargs) as response:
+                    if response.status == 200:
+                        return response.status, await (response.read() if raw else response.json())
+                    status, data = response.status, await response.text()
+                    retry_after = response.headers.get('Retry-After')
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if attempt == GRAPH_MAX_RETRIES:
+                raise
+            status, data = None, str(e)
+
+        # The shared token expired while this mailbox was running, so refresh it once and retry
+        if status == 401 and not refreshed and attempt < GRAPH_MAX_RETRIES:
+            refreshed = True
+            if await refresh_authorization(session):
+                continue
+
+        if status is not None and (status not in GRAPH_RETRY_STATUSES or attempt == GRAPH_MAX_RETRIES):
+            return status, data
+
+        # Wait outside the semaphore so other requests can use the slot meanwhile
+        await asyncio.sleep(retry_delay(attempt, retry_after))
+
+
+async def graph_batch(session, semaphore, urls, description):
+    """Sends GET requests through Graph JSON batching (20 requests per batch).
+
+    `urls` maps a key to a URL relative to the Graph root; returns a mapping of key -> response body
+    for the requests that succeeded.
+    """
+    async def fetch_chunk(chunk):
+        bodies = {}
+        pending = dict(enumerate(chunk))  # Batch request id -> key
+
+        for attempt in range(GRAPH_MAX_RETRIES + 1):
+            batch = {
+                'requests': [
+                    {'id': str(i), 'method': 'GET', 'url': urls[key]}
+                    for i, key in pending.items()
+                ]
             }
+            try:
+                status, data = await graph_request(session, semaphore, 'POST', GRAPH_BATCH_URL, json=batch)
+            except Exception as e:
+                print(f"Error fetching {description} batch: {e}")
+                return bodies
+            if status != 200:
+                print(f"Failed to fetch {description} batch: {status} - {data}")
+                return bodies
+
+            # Individual requests inside a batch are throttled separately, so retry just those
+            throttled = {}
+            retry_after = None
+            for item in data.get('responses', []):
+                i = int(item['id'])
+                key = pending[i]
+                if item.get('status') == 200:
+                    bodies[key] = item.get('body', {})
+                elif item.get('status') in GRAPH_RETRY_STATUSES and attempt < GRAPH_MAX_RETRIES:
+                    throttled[i] = key
+                    retry_after = item.get('headers', {}).get('Retry-After', retry_after)
+                else:
+                    print(f"Failed to fetch {description} for message {key}: {item.get('status')} - {item.get('body')}")
 
-            response = requests.get(url, headers=headers)
-            if response.status_code == 200:
-                messages = response.json().get('value', [])
-                for message in messages:
-                    message['folderName'] = folder['displayName']  # Store the folder name with the message
+            if not throttled:
+                break
+            pending = throttled
+            await asyncio.sleep(retry_delay(attempt, retry_after))
 
-                    # Fetch attachments if enabled in config
-                    if MIGRATE_ATTACHMENTS:
-                        message['attachments'] = fetch_attachments(source_email, message['id'], access_token)
+        return bodies
 
-                all_emails.extend(messages)
-                update_progress(f"Fetched {len(messages)} emails from {folder['displayName']}.")
-            else:
-                print(f"Failed to fetch emails from folder {folder['displayName']}: {response.status_code} - {response.text}")
+    keys = list(urls)
+    chunks = [keys[i:i + GRAPH_BATCH_SIZE] for i in range(0, len(keys), GRAPH_BATCH_SIZE)]
+    results = await asyncio.gather(*(fetch_chunk(chunk) for chunk in chunks))
+
+    all_bodies = {}
+    for bodies in results:
+        all_bodies.update(bodies)
+    return all_bodies
+
+
+async def fetch_attachments_batch(session, semaphore, email_address, message_ids):
+    """Fetch attachments for many messages using Graph JSON batching."""
+    urls = {message_id: f"/users/{email_address}/messages/{message_id}/attachments" for message_id in message_ids}
+    bodies = await graph_batch(session, semaphore, urls, 'attachments')
+    return {message_id: body.get('value', []) for message_id, body in bodies.items()}
 
-        except Exception as e:
-            print(f"Error fetching emails from folder {folder['displayName']}: {e}")
 
-    return all_emails
+async def fetch_messages_batch(session, semaphore, email_address, message_ids):
+    """Fetch the fields needed to rebuild many messages using Graph JSON batching."""
+    urls = {message_id: f"/users/{email_address}/messages/{message_id}?$select={MESSAGE_FIELDS}"
+            for message_id in message_ids}
+    return await graph_batch(session, semaphore, urls, 'message')
 
 
-def get_mail_folders(access_token, user_email):
-    url = f"https://graph.microsoft.com/v1.0/users/{user_email}/mailFolders"
+async def fetch_mime_content(session, semaphore, email_address, message_id):
+    """Fetch the original RFC822 content of a message, or None if it cannot be retrieved."""
+    url = f"https://graph.microsoft.com/v1.0/users/{email_address}/messages/{message_id}/$value"
+    try:
+        status, data = await graph_request(session, semaphore, 'GET', url, raw=True)
+    except Exception as e:
+        print(f"Error fetching MIME content for message {message_id}: {e}")
+        return None
+
+    if status == 200:
+        return data
+    else:
+        print(f"Failed to fetch MIME content for message {message_id}: {status} - {data}")
+        return None
+
+
+async def fetch_messages_chunk(session, semaphore, source_email, folder, messages, message_queue):
+    """Fetch the content of listed messages onto a queue, queueing each one as soon as it is ready."""
+    queued = 0
+    rebuild_ids = [message['id'] for message in messages if message.get('hasAttachments')]
+
+    async def fetch_plain(message):
+        return message, await fetch_mime_content(session, semaphore, source_email, message['id'])
+
+    # Messages without attachments are copied verbatim from their original MIME content
+    plain_messages = [fetch_plain(message) for message in messages if not message.get('hasAttachments')]
+    for next_message in asyncio.as_completed(plain_messages):
+        message, mime_content = await next_message
+        if not mime_content:
+            rebuild_ids.append(message['id'])  # Fall back to rebuilding it from its fields
+            continue
+        message['mimeContent'] = mime_content
+        message['folderName'] = folder['displayName']  # Store the folder name with the message
+        await message_queue.put(message)  # Waits while the consumer is behind
+        queued += 1
+
+    # Everything else is rebuilt by convert_to_rfc822, so fetch its fields
+    details = await fetch_messages_batch(session, semaphore, source_email, rebuild_ids)
+
+    # Fetch attachments if enabled in config, skipping messages that have none
+    attachments = {}
+    if MIGRATE_ATTACHMENTS:
+        message_ids = [message_id for message_id, message in details.items() if message.get('hasAttachments')]
+        attachments = await fetch_attachments_batch(session, semaphore, source_email, message_ids)
+
+    for message_id, message in details.items():  # Failed fetches were already reported by the batch
+        message['folderName'] = folder['displayName']
+        if MIGRATE_ATTACHMENTS:
+            message['attachments'] = attachments.pop(message_id, [])
+        await message_queue.put(message)
+        queued += 1
+
+    return queued
+
+
+async def fetch_folder_messages(session, semaphore, source_email, folder, message_queue):
+    """Fetch all messages (and optionally their attachments) from a single folder onto a queue, page by page."""
+    fetched = 0
+    try:
+        folder_id = folder['id']
+        # List just enough to decide how each message is copied, paging through the whole folder
+        url = (f"https://graph.microsoft.com/v1.0/users/{source_email}/mailFolders/{folder_id}/messages"
+               f"?$select={MESSAGE_LIST_FIELDS}&$top={MESSAGE_PAGE_SIZE}")
+
+        while url:
+            status, data = await graph_request(session, semaphore, 'GET', url)
+            if status != 200:
+                print(f"Failed to fetch emails from folder {folder['displayName']}: {status} - {data}")
+                break
+
+            messages = data.get('value', [])
+            url = data.get('@odata.nextLink')
+
+            # Work through the page one batch-sized chunk at a time so only a few messages are held at once
+            for i in range(0, len(messages), GRAPH_BATCH_SIZE):
+                fetched += await fetch_messages_chunk(
+                    session, semaphore, source_email, folder, messages[i:i + GRAPH_BATCH_SIZE], message_queue)
+
+        update_progress(f"Fetched {fetched} emails from {folder['displayName']}.")
+
+    except Exception as e:
+        print(f"Error fetching emails from folder {folder['displayName']}: {e}")
+
+    return fetched
+
+
+async def stream_emails(account, source_email, access_token):
+    """Yield emails from the source email account one at a time as they are fetched."""
+    if not account.is_authenticated:
+        print("Account is not authenticated. Cannot fetch emails.")
+        return
+
     headers = {
         'Authorization': f'Bearer {access_token}',
         'Content-Type': 'application/json'
     }
-    response = requests.get(url, headers=headers)
+    # Limit the number of in-flight Graph requests for this mailbox
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
 
-    if response.status_code == 200:
-        folders = response.json()
-        return folders  # Successfully retrieved folders
-    else:
-        print(f"Error fetching mail folders: {response.status_code} - {response.text}")
-        return None
+    # Keep a warm pool of keep-alive connections to Graph so requests skip the TCP/TLS handshake
+    connector = aiohttp.TCPConnector(
+        limit_per_host=MAX_CONCURRENT_REQUESTS, keepalive_timeout=GRAPH_KEEPALIVE_TIMEOUT, ttl_dns_cache=300)
+
+    async with aiohttp.ClientSession(headers=headers, connector=connector) as session:
+        folders = await get_mail_folders(session, semaphore, source_email)
+        if folders is None:
+            print("Failed to retrieve folders.")
+            return
+
+        # Both bounded so fetching cannot run arbitrarily far ahead of migration
+        message_queue = asyncio.Queue(maxsize=MAX_QUEUED_MESSAGES)
+        folder_semaphore = asyncio.Semaphore(MAX_CONCURRENT_FOLDERS)
+
+        async def fetch_folder(folder):
+            async with folder_semaphore:
+                return await fetch_folder_messages(session, semaphore, source_email, folder, message_queue)
+
+        async def produce():
+            try:
+                await asyncio.gather(*(fetch_folder(folder) for folder in folders.get('value', [])))
+            finally:
+                await message_queue.put(None)  # Signal that every folder has been fetched
+
+        producer = asyncio.create_task(produce())
+        while (message := await message_queue.get()) is not None:
+            yield message
+        await producer
+
+
+async def get_mail_folders(session, semaphore, user_email):
+    with cache_lock:
+        if user_email in _FOLDER_CACHE:
+            return _FOLDER_CACHE[user_email]  # Folders rarely change during a migration
+
+    url = f"https://graph.microsoft.com/v1.0/users/{user_email}/mailFolders?$top={FOLDER_PAGE_SIZE}"
+
+    # Page through the listing so folders beyond the first page are migrated too
+    folders = []
+    while url:
+        try:
+            status, data = await graph_request(session, semaphore, 'GET', url)
+        except Exception as e:
+            print(f"Error fetching mail folders: {e}")
+            return None
+
+        if status != 200:
+            print(f"Error fetching mail folders: {status} - {data}")
+            return None
+
+        folders.extend(data.get('value', []))
+        url = data.get('@odata.nextLink')
+
+    result = {'value': folders}
+    with cache_lock:
+        _FOLDER_CACHE[user_email] = result
+    return result  # Successfully retrieved folders
+
+
+class _BodyExtractor(HTMLParser):
+    """Collects the text content of an HTML body, skipping script and style elements."""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)  # Decode entities inline
+        self.parts = []
+        self._skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ('script', 'style'):
+            self._skip_depth += 1
+
+    def handle_endtag(self, tag):
+        if tag in ('script', 'style') and self._skip_depth:
+            self._skip_depth -= 1
+
+    def handle_data(self, data):
+        if not self._skip_depth:
+            self.parts.append(data)
 
 
 def extract_email_body(msg):
     """Extracts and cleans the email body from the message."""
-    body = ""
-
-    if 'body' in msg and 'content' in msg['body']:
-        if msg['body']['contentType'] == 'html':
-            html_content = msg['body']['content']
-            body = re.sub(r'<[^>]+>', '', html_content)  # Remove tags
-            body = re.sub(r'\s+', ' ', body)  # Replace multiple spaces/newlines with a single space
-        elif msg['body']['contentType'] == 'text':
-            body = msg['body']['content']
+    body = msg.get('body') or {}
+    content = body.get('content') or ''
 
-    body = html.unescape(body.strip())
+    if body.get('contentType') == 'html':
+        parser = _BodyExtractor()  # Strips tags and decodes entities
+        parser.feed(content)
+        parser.close()
+        content = _WS_RE.sub(' ', ''.join(parser.parts))  # Replace multiple spaces/newlines with a single space
+    elif body.get('contentType') != 'text':
+        content = ''
 
-    return body if body else "(No Body)"  # Default if no body found
+    # Plain-text bodies are passed through as-is
+    return content.strip() or "(No Body)"  # Default if no body found
 
 
 def convert_to_rfc822(msg):
@@ -205,23 +540,10 @@ def convert_to_rfc822(msg):
         subject = msg.get('subject', '(No Subject)')
         sender = msg.get('from', {}).get('emailAddress', {}).get('address', 'unknown@example.com')
 
-        recipients = msg.get('toRecipients', [])
-        recipient_list = ', '.join(
-            [rec.get('emailAddress', {}).get('address', 'unknown@example.com') for rec in recipients])
-
-        cc_recipients = msg.get('ccRecipients', [])
-        cc_list = ', '.join(
-            [rec.get('emailAddress', {}).get('address', 'unknown@example.com') for rec in cc_recipients])
-
-        bcc_recipients = msg.get('bccRecipients', [])
-        bcc_list = ', '.join(
-            [rec.get('emailAddress', {}).get('address', 'unknown@example.com') for rec in bcc_recipients])
-
-        all_recipients = recipient_list
-        if cc_list:
-            all_recipients += f", {cc_list}"
-        if bcc_list:
-            all_recipients += f", {bcc_list}"
+        # Join To, Cc and Bcc recipients in a single pass
+        all_recipients = ', '.join(
+            rec.get('emailAddress', {}).get('address', 'unknown@example.com')
+            for rec in itertools.chain(msg.get('toRecipients') or (), msg.get('ccRecipients') or (), msg.get('bccRecipients') or ()))
 
         date = msg.get('receivedDateTime', 'Tue, 01 Jan 2000 00:00:00 +0000')
         body = extract_email_body(msg)
@@ -242,14 +564,17 @@ def convert_to_rfc822(msg):
             for attachment in msg['attachments']:
                 try:
                     mime_attachment = MIMEBase('application', 'octet-stream')
-                    attachment_content = base64.b64decode(attachment.get('contentBytes', ''))
 
-                    mime_attachment.set_payload(attachment_content)
-                    encoders.encode_base64(mime_attachment)
+                    # Graph already returns base64, so use it as the payload (wrapped to 76-char lines)
+                    content_bytes = attachment.get('contentBytes', '')
+                    mime_attachment.set_payload('\n'.join(
+                        content_bytes[i:i + 76] for i in range(0, len(content_bytes), 76)))
+                    mime_attachment.add_header('Content-Transfer-Encoding', 'base64')
 
+                    # Passing the filename as a parameter RFC 2231-encodes non-ASCII names
                     mime_attachment.add_header(
-                        'Content-Disposition',
-                        f'attachment; filename="{attachment.get("name", "unknown")}"'
+                        'Content-Disposition', 'attachment',
+                        filename=attachment.get("name", "unknown")
                     )
 
                     email_msg.attach(mime_attachment)
@@ -265,8 +590,9 @@ def convert_to_rfc822(msg):
         email_msg['Subject'] = subject
         email_msg['Date'] = date
 
-        # Return the email message in RFC822 format
-        return email_msg.as_string()
+        # Return the email message in RFC822 format, as the CRLF-terminated bytes IMAP APPEND expects
+        # (keeping compat32, which RFC 2047-encodes the raw str headers set above)
+        return email_msg.as_bytes(policy=email_msg.policy.clone(linesep='\r\n'))
 
     except Exception as e:
         print(f"Conversion error: {e}, message: {msg}")  # Log the error and message
@@ -287,15 +613,24 @@ def connect_to_target_imap(server, email_user, password=None):
         print(f"An unexpected error occurred: {e}")
         return None
 
-def select_target_folder(target_mail, source_folder_name):
-    """Selects a target folder based on the source folder name."""
-    try:
-        # Get a list of available folders in the target mailbox
+def list_target_folders(target_mail):
+    """Returns the folders available on a target connection, running LIST only once per connection."""
+    available_folders = getattr(target_mail, '_folder_cache', None)
+    if available_folders is None:
         status, folders = target_mail.list()
-        available_folders = [folder.decode().split(' "/" ')[-1] for folder in folders]
+        available_folders = [folder.decode().split(' "/" ')[-1].strip('"') for folder in folders]
+        target_mail._folder_cache = available_folders
 
         # Log available folders
         print(f"Available target folders: {available_folders}")
+    return available_folders
+
+
+def select_target_folder(target_mail, source_folder_name):
+    """Selects a target folder based on the source folder name."""
+    try:
+        # Get a list of available folders in the target mailbox
+        available_folders = list_target_folders(target_mail)
 
         # Clean the folder name for matching
         target_folder_name = clean_folder_name(source_folder_name)
@@ -323,122 +658,278 @@ def get_target_folders(target_mail):
     return folder_mapping
 
 
-def migrate_emails(target_mail, messages):
-    """Migrates emails from a list of message dictionaries to a target email account."""
-    target_folders = get_target_folders(target_mail)  # Get the mapping of target folders
+def supports_multiappend(target_mail):
+    """Checks whether the target server accepts MULTIAPPEND (RFC 3502) with non-synchronizing literals."""
+    try:
+        status, data = target_mail.capability()  # Servers often advertise more after login
+        capabilities = data[-1].decode().upper().split() if status == 'OK' else target_mail.capabilities
+    except Exception:
+        capabilities = target_mail.capabilities
+    return 'MULTIAPPEND' in capabilities and 'LITERAL+' in capabilities and not target_mail.utf8_enabled
+
+
+def quote_mailbox(mailbox):
+    """Quotes a mailbox name for use in an IMAP command when it contains spaces or special characters."""
+    if mailbox and not _QUOTE_RE.search(mailbox):
+        return mailbox
+    return '"' + mailbox.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def multiappend(target_mail, mailbox, internaldate, email_messages):
+    """Appends several messages to one mailbox with a single MULTIAPPEND command."""
+    tag = target_mail._new_tag()
+    target_mail.send(tag + b' APPEND ' + mailbox.encode(target_mail._encoding))
+
+    # LITERAL+ lets every literal follow immediately without waiting for a continuation,
+    # so each message is sent on its own instead of being copied into one large buffer
+    for email_message in email_messages:
+        literal = imaplib.MapCRLF.sub(imaplib.CRLF, email_message)
+        target_mail.send(b' %s {%d+}\r\n' % (internaldate.encode(), len(literal)))
+        target_mail.send(literal)
+    target_mail.send(imaplib.CRLF)
+
+    return target_mail._command_complete('APPEND', tag)
+
+
+def append_messages(target_mail, target_folder_name, internaldate, email_messages, use_multiappend=False):
+    """Appends messages to a target folder, in one MULTIAPPEND when possible, retrying dropped connections.
+
+    Returns the number of messages the server accepted.
+    """
+    mailbox = quote_mailbox(target_folder_name)  # imaplib sends mailbox names verbatim
+
+    if use_multiappend and len(email_messages) > 1:
+        retry_count = 3
+        for attempt in range(retry_count):
+            try:
+                status, response = multiappend(target_mail, mailbox, internaldate, email_messages)
+                if status == 'OK':
+                    return len(email_messages)
+                # A failed MULTIAPPEND appends nothing, so retry the messages one at a time
+                # to keep one rejected message from dropping the rest of the batch
+                update_progress(f"MULTIAPPEND to {target_folder_name} failed, appending messages one at a time: {response}")
+                break
+            except (OSError, imaplib.IMAP4.abort) as e:
+                if attempt == retry_count - 1:
+                    update_progress(f"Failed to append messages to {target_folder_name} after {retry_count} attempts: {e}")
+                    return 0
+                time.sleep(2 ** attempt)  # Back off exponentially before retrying
+            except Exception as e:
+                update_progress(f"MULTIAPPEND rejected, appending messages one at a time: {e}")
+                break
+
+    appended = 0
+    for email_message in email_messages:
+        retry_count = 3
+        for attempt in range(retry_count):
+            try:
+                # Append email message to the target folder
+                status, response = target_mail.append(
+                    mailbox, None, internaldate, email_message
+                )
+                if status == 'OK':
+                    appended += 1
+                else:
+                    update_progress(f"Failed to append message to {target_folder_name}: {response}")
+                break  # Exit retry loop on success
+            except (OSError, imaplib.IMAP4.abort) as e:
+                if attempt == retry_count - 1:
+                    update_progress(f"Failed to append message to {target_folder_name} after {retry_count} attempts: {e}")
+                    break
+                time.sleep(2 ** attempt)  # Back off exponentially before retrying
+            except Exception as e:
+                update_progress(f"Error appending message: {e}")  # Log the error
+                break
+
+    return appended
+
+
+def estimated_size(msg):
+    """Estimates how many bytes a message dictionary will take once converted to RFC822."""
+    if msg.get('mimeContent'):
+        return len(msg['mimeContent'])
+    body = (msg.get('body') or {}).get('content') or ''
+    return len(body) + sum(len(attachment.get('contentBytes') or '') for attachment in msg.get('attachments') or ())
+
+
+def migrate_batch(target_mail, target_folders, internaldate, source_folder, messages, use_multiappend=False):
+    """Migrates message dictionaries from one source folder over the given target connection.
+
+    Returns the number of messages appended.
+    """
+    email_messages = []
+    for msg in messages:
+        # Use the original MIME content when available, otherwise convert the message to RFC822 format
+        email_message = msg.get('mimeContent') or convert_to_rfc822(msg)
+        if isinstance(email_message, bytes):
+            email_messages.append(email_message)
+        else:
+            update_progress(f"Email conversion failed for message: {msg}")
 
-    total_messages = len(messages)  # Total number of messages
-    for idx, msg in enumerate(messages):  # Iterate with index for progress tracking
-        try:
-            if isinstance(msg, dict):
-                subject = msg.get('subject', '(No Subject)')
-                source_folder = msg.get('folderName', 'Inbox')
+    if not email_messages:
+        return 0
 
-                # Determine target folder name based on the source folder
-                target_folder_name = target_folders.get(source_folder, "INBOX")
-
-                # Convert email message to RFC822 format
-                email_message = convert_to_rfc822(msg)
-
-                if isinstance(email_message, str):
-                    email_message_bytes = email_message.encode('utf-8')
-                    retry_count = 3
-                    for attempt in range(retry_count):
-                        try:
-                            # Append email message to the target folder
-                            status, response = target_mail.append(
-                                target_folder_name, None,
-                                imaplib.Time2Internaldate(time.time()), email_message_bytes
-                            )
-                            if status != 'OK':
-                                update_progress(f"Failed to append message to {target_folder_name}: {response}")
-                            break  # Exit retry loop on success
-                        except (OSError, imaplib.IMAP4.abort) as e:
-                            time.sleep(2)  # Wait before retrying
-                        except Exception as e:
-                            update_progress(f"Error appending message: {e}")  # Log the error
-                            break
-                else:
-                    update_progress(f"Email conversion failed for message: {msg}")
-            else:
-                update_progress(f"Unexpected message format: {msg}")
+    # Determine target folder name based on the source folder
+    target_folder_name = target_folders.get(source_folder, "INBOX")
 
-            # Custom progress update
-            progress_percentage = (idx + 1) / total_messages * 100
-            update_progress(f"Migrating Emails: {progress_percentage:.2f}% ({idx + 1}/{total_messages})")
+    return append_messages(target_mail, target_folder_name, internaldate, email_messages, use_multiappend)
 
-        except Exception as e:
-            update_progress(f"Error migrating email: {e}")
+
+async def migrate_emails(connections, messages, progress_key):
+    """Migrates emails as they arrive from an async iterator, pipelining fetching with appends.
+
+    A producer groups incoming messages into batches on a bounded queue while one consumer per target
+    IMAP connection appends them, so Graph downloads and IMAP uploads overlap.
+    Returns the number of messages processed.
+    """
+    target_folders = await asyncio.to_thread(get_target_folders, connections[0])  # Get the mapping of target folders
+    use_multiappend = await asyncio.to_thread(supports_multiappend, connections[0])
+
+    # Group messages per folder for MULTIAPPEND, otherwise append them one by one
+    batch_size = MULTIAPPEND_BATCH_SIZE if use_multiappend else 1
+
+    # INTERNALDATE only needs to be formatted once for the whole mailbox
+    internaldate = imaplib.Time2Internaldate(time.time())
+
+    # Bounded so fetching cannot run arbitrarily far ahead of the appends
+    batch_queue = asyncio.Queue(maxsize=len(connections))
+    migrated = 0
+
+    async def produce():
+        total_messages = 0
+        batches = {}  # Source folder -> (messages waiting to be appended, their estimated size in bytes)
+        try:
+            async for msg in messages:
+                total_messages += 1
+                if not isinstance(msg, dict):
+                    update_progress(f"Unexpected message format: {msg}")
+                    continue
+
+                source_folder = msg.get('folderName', 'Inbox')
+                batch, batch_bytes = batches.get(source_folder, ([], 0))
+                batch.append(msg)
+                batch_bytes += estimated_size(msg)
+                batches[source_folder] = (batch, batch_bytes)
+
+                # Cap batches by size as well as count so large attachments do not pile up in memory
+                if len(batch) >= batch_size or batch_bytes >= MULTIAPPEND_BATCH_BYTES:
+                    del batches[source_folder]
+                    await batch_queue.put((source_folder, batch))
+
+            for source_folder, (batch, _) in batches.items():
+                await batch_queue.put((source_folder, batch))
+        finally:
+            for _ in connections:
+                await batch_queue.put(None)  # Tell every consumer there is nothing left
+        return total_messages
+
+    async def consume(target_mail):
+        nonlocal migrated
+        while (item := await batch_queue.get()) is not None:
+            source_folder, batch = item
+            try:
+                # imaplib is blocking, so run the conversion and APPEND off the event loop
+                appended = await asyncio.to_thread(
+                    migrate_batch, target_mail, target_folders, internaldate, source_folder, batch, use_multiappend)
+            except Exception as e:
+                update_progress(f"Error migrating email: {e}")
+                continue
+
+            # Progress is printed by report_progress, not per append; only count what the server accepted
+            migrated += appended
+            _PROGRESS[progress_key] = migrated
+
+    total_messages, *_ = await asyncio.gather(produce(), *(consume(target_mail) for target_mail in connections))
+    return total_messages
 
 
 def clean_folder_name(folder_name):
     """Cleans the folder name for compatibility with the target IMAP server."""
-    folder_name = re.sub(r'[<>:"/\\|?*]', '', folder_name)  # Remove illegal characters
+    folder_name = _ILLEGAL_RE.sub('', folder_name)  # Remove illegal characters
     return folder_name.strip()[:50]  # Trim to 50 characters if needed
 
-def read_mailboxes_from_csv(filename):
-    """Reads mailboxes from a CSV file."""
-    mailboxes = []
+def iter_mailboxes(filename):
+    """Yields mailboxes from a CSV file one row at a time."""
     try:
-        with open(filename, 'r') as csvfile:
-            csvreader = csv.reader(csvfile)
-            next(csvreader)  # Skip the header
+        with open(filename, 'r', newline='') as csvfile:
+            csvreader = csv.DictReader(csvfile)  # Columns are named by the header row
             for row in csvreader:
-                if len(row) == 4:  # Ensure the CSV has four columns
-                    source_email = row[0]
-                    target_server = row[1]
-                    target_email = row[2]
-                    target_password = row[3]
-                    mailboxes.append((source_email, target_server, target_email, target_password))
+                mailbox = (row.get('source_email'), row.get('target_server'),
+                           row.get('target_email'), row.get('target_password'))
+                if all(mailbox):  # Ensure the row has all four columns
+                    yield mailbox
+                else:
+                    print(f"Skipping incomplete CSV row: {row.get('source_email')}")
     except Exception as e:
         print(f"Error reading CSV file: {e}")
-    return mailboxes
-
 
-def migrate_mailbox(mailbox):
-    """Migrates a single mailbox."""
-    source_email, target_server, target_email, target_password = mailbox  # Unpack all four columns
 
+async def migrate_mailbox_async(source_email, target_server, target_email, target_password):
+    """Migrates a single mailbox, fetching from Graph and appending over IMAP concurrently."""
     update_progress(f"Starting migration from {source_email} to {target_email}.")
 
-    access_token, account = authenticate_account(source_email)
+    access_token, account = await asyncio.to_thread(authenticate_account, source_email)
     if access_token is None:
         update_progress(f"Authentication failed for {source_email}. Skipping this mailbox.")
         return
 
-    messages = fetch_all_emails(account, source_email, access_token)
+    # Open several connections to the target IMAP server at once so appends run in parallel
+    connections = await asyncio.gather(
+        *(asyncio.to_thread(connect_to_target_imap, target_server, target_email, target_password)  # Use the target server and password
+          for _ in range(IMAP_CONNECTIONS_PER_MAILBOX)))
+    connections = [target_mail for target_mail in connections if target_mail is not None]
 
-    if messages:
-        # Connect to target IMAP server with the specified server and password
-        target_mail = connect_to_target_imap(target_server, target_email, target_password)  # Use the target server and password
-        if target_mail is None:
-            update_progress(f"Failed to connect to target IMAP server for {target_email}.")
-            return
+    if not connections:
+        update_progress(f"Failed to connect to target IMAP server for {target_email}.")
+        return
 
-        migrate_emails(target_mail, messages)
-        target_mail.logout()  # Log out from the target IMAP server
+    try:
+        # Messages are appended as soon as they are fetched instead of being collected first
+        total_messages = await migrate_emails(
+            connections, stream_emails(account, source_email, access_token), (source_email, target_email))
+    finally:
+        # Log out all connections from the target IMAP server
+        for target_mail in connections:
+            try:
+                await asyncio.to_thread(target_mail.logout)
+            except Exception as e:
+                print(f"Error logging out from {target_server}: {e}")
+
+    if total_messages:
         update_progress(f"Migration completed for {source_email} to {target_email}.")
         print()  # Move to next line after migration completion
     else:
         update_progress(f"No messages to migrate from {source_email}.")
 
 
+def migrate_mailbox(mailbox):
+    """Migrates a single mailbox."""
+    source_email, target_server, target_email, target_password = mailbox  # Unpack all four columns
+    asyncio.run(migrate_mailbox_async(source_email, target_server, target_email, target_password))
+
 
 def main():
     csv_filename = 'details.csv'  # Replace with your CSV filename
-    mailboxes = read_mailboxes_from_csv(csv_filename)
-    if not mailboxes:
-        print("No mailboxes found to migrate.")
-        return
 
-    threads = []
-    for mailbox in mailboxes:
-        thread = threading.Thread(target=migrate_mailbox, args=(mailbox,))
-        threads.append(thread)
-        thread.start()
+    # Print aggregated progress from a single background thread
+    stop_event = threading.Event()
+    reporter = threading.Thread(target=report_progress, args=(stop_event,), daemon=True)
+    reporter.start()
+
+    # Migrate mailboxes in parallel, bounded by MAX_PARALLEL_MAILBOXES; each starts as soon as its row is read
+    try:
+        with ThreadPoolExecutor(max_workers=MAX_PARALLEL_MAILBOXES) as executor:
+            total_mailboxes = sum(1 for _ in executor.map(migrate_mailbox, iter_mailboxes(csv_filename)))
+    finally:
+        stop_event.set()
+        reporter.join()
 
-    for thread in threads:
-        thread.join()
+    if _PROGRESS:
+        update_progress(f"Migrated {sum(_PROGRESS.values())} emails across {len(_PROGRESS)} mailboxes.", final=True)
+
+    if not total_mailboxes:
+        print("No mailboxes found to migrate.")
+        return
 
     print("All mailboxes have been migrated.")
 